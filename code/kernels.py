@@ -0,0 +1,38 @@
+"""Numba kernels of the pipeline.
+
+Kept out of main.py so that main.py can be compiled ahead of time with mypyc: Numba needs plain Python functions.
+"""
+from typing import Any, Callable
+
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args: Any, **kwargs: Any) -> Callable[[Callable[..., Any]], Callable[..., Any]]:  # type: ignore[no-redef]
+        return lambda func: func
+
+
+@njit(cache=True)
+def nearest_gather(timestamps: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray, target_timestamps: np.ndarray, out_latitudes: np.ndarray, out_longitudes: np.ndarray) -> None:
+    """Fused search + gather: write the coordinates closest to every target into the out arrays."""
+    n = len(timestamps)
+    for i in range(len(target_timestamps)):
+        target = target_timestamps[i]
+        lo = 0
+        hi = n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if timestamps[mid] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == n:
+            lo = n - 1
+        elif lo > 0 and target - timestamps[lo - 1] <= timestamps[lo] - target:
+            lo -= 1
+        out_latitudes[i] = latitudes[lo]
+        out_longitudes[i] = longitudes[lo]
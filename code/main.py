@@ -1,119 +1,235 @@
-from datetime import datetime
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
 import json
 import os
+import time
+from typing import Any, Mapping
+import zipfile
+
+import numpy as np
+
+from kernels import NUMBA_AVAILABLE, nearest_gather
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+def json_loads(data: bytes | str) -> Any:
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj: Any) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, indent=2).encode()
+
+POS_CACHE_SUFFIX = '.cache.npz'
+WRITER_THREADS = 4
+
+# (timestamps, latitudes, longitudes) of the .pos rows: int64 nanoseconds and float64 degrees.
+PosData = tuple[np.ndarray, np.ndarray, np.ndarray]
+# (indices, timestamps, latitudes, longitudes) of the JSON frames.
+Associations = tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
 
 
 #Parse Input Files
 #----------------------------------------------------------------------------------------------------------------#
-def parse_json_file(file_path):
-    """Parses a JSON file and returns the data."""
+def parse_json_file(file_path: str) -> Any:
+    """Parses a JSON file and returns the data.
+
+    Results are memoized per (path, mtime, size) and shared between calls, so callers must not modify them.
+    """
     try:
-        with open(file_path, 'r') as file:
-            data = json.load(file)
-        return data
+        stat = os.stat(file_path)
+    except OSError:
+        return _read_json_file(file_path)
+    return _read_json_file_cached(file_path, stat.st_mtime_ns, stat.st_size)
+
+@functools.lru_cache(maxsize=64)
+def _read_json_file_cached(file_path: str, mtime_ns: int, size: int) -> Any:
+    return _read_json_file(file_path)
+
+def _read_json_file(file_path: str) -> Any:
+    try:
+        with open(file_path, 'rb') as file:
+            data = json_loads(file.read())
     except (IOError, json.JSONDecodeError) as e:
         print(f"Error reading JSON file {file_path}: {e}")
         return None
+    return data
+
+def parse_pos_file(file_path: str, use_cache: bool = True) -> PosData | None:
+    """Parses a .pos file and returns parallel (timestamps, latitudes, longitudes) arrays.
+
+    The file is streamed line by line into growable typed buffers, so it is never held in memory as a whole.
+    With use_cache the parsed arrays are stored in a '.cache.npz' sidecar and reused while the .pos file is unchanged.
+    """
+    cache_path = file_path + POS_CACHE_SUFFIX
+    cache_key: np.ndarray | None
+    try:
+        cache_key = _pos_cache_key(os.stat(file_path))
+    except OSError:
+        cache_key = None
 
-def parse_pos_file(file_path):
-    """Parses a .pos file and returns a list of (timestamp, latitude, longitude) tuples."""
+    if use_cache and cache_key is not None:
+        cached = _load_pos_cache(cache_path, cache_key)
+        if cached is not None:
+            return cached
+
+    timestamps = array('q')
+    latitudes = array('d')
+    longitudes = array('d')
     try:
         with open(file_path, 'r') as file:
-            lines = file.readlines()
+            if not any(line.startswith('%  GPST') for line in file):
+                print(f"No data start marker found in file {file_path}")
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+
+            # The header scan above left the iterator on the first data line, so this is still the same single pass.
+            for line in file:
+                if line.startswith('%'):
+                    continue
+                parts = line.split()
+                if not parts:
+                    continue
+                timestamps.append(pos_time_to_timestamp(parts[0], parts[1]))
+                latitudes.append(float(parts[2]))
+                longitudes.append(float(parts[3]))
     except IOError as e:
         print(f"Error reading .pos file {file_path}: {e}")
         return None
 
-    data_start_index = next((i + 1 for i, line in enumerate(lines) if line.startswith('%  GPST')), None)
-    if data_start_index is None:
-        print(f"No data start marker found in file {file_path}")
-        return []
-    
-    pos_data = []
-    for line in lines[data_start_index:]:
-        if line.startswith('%') or not line.strip():
-            continue
-        parts = line.split()
-        timestamp = date_str_to_timestamp(datetime.strptime(f"{parts[0]} {parts[1]}", "%Y/%m/%d %H:%M:%S.%f"))
-        latitude = float(parts[2])
-        longitude = float(parts[3])
-        pos_data.append((timestamp, latitude, longitude))
-    
+    pos_timestamps: np.ndarray = np.frombuffer(timestamps, dtype=np.int64)
+    pos_latitudes: np.ndarray = np.frombuffer(latitudes, dtype=np.float64)
+    pos_longitudes: np.ndarray = np.frombuffer(longitudes, dtype=np.float64)
+    # Timestamp lookups binary-search the timestamps, so make sure they are sorted (they usually already are).
+    if np.any(np.diff(pos_timestamps) < 0):
+        order = np.argsort(pos_timestamps, kind='stable')
+        pos_timestamps, pos_latitudes, pos_longitudes = pos_timestamps[order], pos_latitudes[order], pos_longitudes[order]
+    # Coordinates are validated here, once per .pos file, so the per-file hot path can trust them.
+    valid = np.isfinite(pos_latitudes) & np.isfinite(pos_longitudes)
+    if not valid.all():
+        print(f"Skipping {np.count_nonzero(~valid)} rows with invalid coordinates in file {file_path}")
+        pos_timestamps, pos_latitudes, pos_longitudes = pos_timestamps[valid], pos_latitudes[valid], pos_longitudes[valid]
+
+    pos_data = (pos_timestamps, pos_latitudes, pos_longitudes)
+    if use_cache and cache_key is not None:
+        _save_pos_cache(cache_path, cache_key, pos_data)
     return pos_data
 
-def date_str_to_timestamp(dt):
-    """Converts a datetime object to a timestamp with nanoseconds."""
-    timestamp_seconds = dt.timestamp()
-    microseconds = dt.microsecond
-    nanoseconds = microseconds * 1000
-    timestamp_with_nanoseconds = int(timestamp_seconds * 1e9) + nanoseconds
-    return timestamp_with_nanoseconds
+def _pos_cache_key(stat: os.stat_result) -> np.ndarray:
+    """Cache key of a .pos file: its mtime and size, plus the local timezone the timestamps were computed in."""
+    return np.array([stat.st_mtime_ns, stat.st_size, time.timezone, time.altzone], dtype=np.int64)
+
+def _load_pos_cache(cache_path: str, cache_key: np.ndarray) -> PosData | None:
+    """Returns the cached (timestamps, latitudes, longitudes) arrays, or None if the cache is missing or stale."""
+    try:
+        with np.load(cache_path) as cache:
+            if not np.array_equal(cache['key'], cache_key):
+                return None
+            return cache['timestamps'], cache['latitudes'], cache['longitudes']
+    except (IOError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+def _save_pos_cache(cache_path: str, cache_key: np.ndarray, pos_data: PosData) -> None:
+    """Atomically writes the parsed .pos arrays to the cache sidecar."""
+    timestamps, latitudes, longitudes = pos_data
+    tmp_path = cache_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, key=cache_key, timestamps=timestamps, latitudes=latitudes, longitudes=longitudes)
+        os.replace(tmp_path, cache_path)
+    except IOError as e:
+        print(f"Error writing .pos cache {cache_path}: {e}")
+
+@functools.lru_cache(maxsize=4096)
+def _local_hour_to_seconds(year: int, month: int, day: int, hour: int) -> int:
+    """Epoch seconds of the start of the given local-time hour (consecutive .pos rows share it)."""
+    return int(time.mktime((year, month, day, hour, 0, 0, 0, 0, -1)))
+
+def pos_time_to_timestamp(date_str: str, time_str: str) -> int:
+    """Converts .pos 'YYYY/MM/DD' and 'HH:MM:SS.fff' fields (local time) to a timestamp with nanoseconds."""
+    seconds = _local_hour_to_seconds(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]), int(time_str[0:2]))
+    seconds += int(time_str[3:5]) * 60 + int(time_str[6:8])
+    fraction = time_str[9:18]
+    nanoseconds = int(fraction.ljust(9, '0')) if fraction else 0
+    return seconds * 1_000_000_000 + nanoseconds
 #----------------------------------------------------------------------------------------------------------------#
 
 
 #Associate Timestamps with GPS Coordinates
 #----------------------------------------------------------------------------------------------------------------#
-def find_closest_timestamp(pos_data, target_timestamp):
-    """Find the closest timestamp in pos_data to the target_timestamp."""
-    closest = min(pos_data, key=lambda x: abs(x[0] - target_timestamp))
-    return closest[1], closest[2]
-
-def associate_timestamps_with_gps(json_data, pos_data):
-    """Associate each timestamp in json_data with the closest GPS coordinates from pos_data."""
-    associations = []
-    for frame in json_data['timestamps']:
-        frame_index = frame[0]
-        frame_timestamp = frame[1]
-        latitude, longitude = find_closest_timestamp(pos_data, frame_timestamp)
-        associations.append({
-            'index': frame_index,
-            'timestamp': frame_timestamp,
-            'latitude': latitude,
-            'longitude': longitude
-        })
-    return associations
+def find_closest_indices(timestamps: np.ndarray, target_timestamps: np.ndarray) -> np.ndarray:
+    """Index of the closest timestamp for every target; timestamps must be sorted, as returned by parse_pos_file."""
+    idx = np.searchsorted(timestamps, target_timestamps)
+    right = np.clip(idx, 0, len(timestamps) - 1)
+    left = np.clip(idx - 1, 0, len(timestamps) - 1)
+    use_left = (target_timestamps - timestamps[left]) <= (timestamps[right] - target_timestamps)
+    return np.where(use_left, left, right)
+
+def associate_timestamps_with_gps(json_data: Mapping[str, Any], pos_data: PosData) -> Associations:
+    """Associate each timestamp in json_data with the closest GPS coordinates from pos_data.
+
+    Returns parallel (indices, timestamps, latitudes, longitudes) arrays, one entry per frame.
+    """
+    timestamps, latitudes, longitudes = pos_data
+    if len(timestamps) == 0:
+        raise ValueError("The .pos data is empty")
+    frame_list = json_data['timestamps']
+    frames = np.array(frame_list, dtype=np.int64) if len(frame_list) else np.empty((0, 2), dtype=np.int64)
+    if frames.ndim != 2 or frames.shape[1] < 2:
+        raise ValueError("Each frame must be an [index, timestamp, ...] list")
+    frame_indices = np.ascontiguousarray(frames[:, 0])
+    frame_timestamps = np.ascontiguousarray(frames[:, 1])
+
+    if NUMBA_AVAILABLE:
+        frame_latitudes = np.empty(len(frames), dtype=np.float64)
+        frame_longitudes = np.empty(len(frames), dtype=np.float64)
+        nearest_gather(timestamps, latitudes, longitudes, frame_timestamps, frame_latitudes, frame_longitudes)
+    else:
+        closest = find_closest_indices(timestamps, frame_timestamps)
+        frame_latitudes = latitudes[closest]
+        frame_longitudes = longitudes[closest]
+
+    return frame_indices, frame_timestamps, frame_latitudes, frame_longitudes
 #----------------------------------------------------------------------------------------------------------------#
 
 
 #Calculate Centroid
 #----------------------------------------------------------------------------------------------------------------#
-def calculate_centroid(locations):
-    if not locations:
+def calculate_centroid(latitudes: np.ndarray, longitudes: np.ndarray) -> tuple[float, float]:
+    """Calculate the centroid of the given latitude/longitude arrays with a vectorized mean."""
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    if len(latitudes) == 0 or len(longitudes) == 0:
         raise ValueError("The list of locations is empty")
     
-    if not all('latitude' in loc and 'longitude' in loc for loc in locations):
-        raise ValueError("Each location must have 'latitude' and 'longitude' keys")
-    
-    latitudes = [loc['latitude'] for loc in locations]
-    longitudes = [loc['longitude'] for loc in locations]
+    if len(latitudes) != len(longitudes):
+        raise ValueError("Latitude and longitude arrays must have the same length")
     
-    if not latitudes or not longitudes:
-        raise ValueError("Latitude and longitude lists cannot be empty")
-    
-    centroid_lat = sum(latitudes) / len(latitudes)
-    centroid_lon = sum(longitudes) / len(longitudes)
-    return centroid_lat, centroid_lon
+    return float(latitudes.mean()), float(longitudes.mean())
 #----------------------------------------------------------------------------------------------------------------#
 
 
 #Generate GeoJSON Output
 #----------------------------------------------------------------------------------------------------------------#
-def generate_geojson_output(json_data, associations, centroid):
+def generate_geojson_output(json_data: Mapping[str, Any], associations: Associations, centroid: tuple[float, float]) -> dict[str, Any]:
     """Generate a GeoJSON output from the provided data."""
-    features = [
-        {
+    indices, timestamps, latitudes, longitudes = associations
+    # One C-level conversion yields every [lon, lat] pair instead of assembling them per feature.
+    coordinates = np.column_stack((longitudes, latitudes)).tolist()
+    # Filled by index into a preallocated list, so it never has to grow while the features are built.
+    features: list[Any] = [None] * len(coordinates)
+    for i, (index, timestamp, coordinate) in enumerate(zip(indices.tolist(), timestamps.tolist(), coordinates)):
+        features[i] = {
             "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [assoc['longitude'], assoc['latitude']]
-            },
-            "properties": {
-                "index": assoc['index'],
-                "timestamp": assoc['timestamp']
-            }
+            "geometry": {"type": "Point", "coordinates": coordinate},
+            "properties": {"index": index, "timestamp": timestamp}
         }
-        for assoc in associations
-    ]
 
     geojson = {
         "type": "FeatureCollection",
@@ -131,11 +247,11 @@ def generate_geojson_output(json_data, associations, centroid):
     
     return geojson
 
-def write_geojson_file(filepath, geojson):
+def write_geojson_file(filepath: str, geojson: Mapping[str, Any]) -> None:
     """Write the GeoJSON data to a file."""
     try:
-        with open(filepath, 'w') as file:
-            json.dump(geojson, file, indent=4)
+        with open(filepath, 'wb') as file:
+            file.write(json_dumps(geojson))
     except IOError as e:
         print(f"An error occurred while writing the file: {e}")
 #----------------------------------------------------------------------------------------------------------------#
@@ -143,22 +259,68 @@ def write_geojson_file(filepath, geojson):
 
 #Main Function
 #----------------------------------------------------------------------------------------------------------------#
-def process_files(folder, output_file: str = 'geojson'):
-    files = os.listdir(folder)
-    json_files = [(index, os.path.join(folder, file)) for index, file in enumerate(files) if file.endswith('.json')]
-    pos_file = next((os.path.join(folder, file) for file in files if file.endswith('.pos')), None)
+def process_one(json_data: Mapping[str, Any], pos_timestamps: np.ndarray, pos_latitudes: np.ndarray, pos_longitudes: np.ndarray) -> dict[str, Any]:
+    """Run the whole pipeline for one JSON file's data and return its GeoJSON.
+
+    Frames are matched, averaged and emitted straight from the per-frame arrays; no per-frame records are built.
+    """
+    associations = associate_timestamps_with_gps(json_data, (pos_timestamps, pos_latitudes, pos_longitudes))
+    _, _, latitudes, longitudes = associations
+    centroid = calculate_centroid(latitudes, longitudes)
+    return generate_geojson_output(json_data, associations, centroid)
+
+# The parsed .pos data of a process-pool worker, sent once per worker by _init_worker rather than with every task.
+_worker_pos_data: PosData | None = None
+
+def _init_worker(pos_data: PosData) -> None:
+    global _worker_pos_data
+    _worker_pos_data = pos_data
+
+def _process_task(task: tuple[str, str]) -> None:
+    """Process a single JSON file against the worker's .pos data and write its GeoJSON output."""
+    json_file, output_path = task
+    if _worker_pos_data is None:
+        raise RuntimeError("The worker was not initialized with the .pos data")
+    write_geojson_file(output_path, process_one(parse_json_file(json_file), *_worker_pos_data))
+
+def process_files(folder: str, output_file: str = 'geojson', max_workers: int | None = None) -> None:
+    """Process every JSON file in the folder, fanning out across up to max_workers processes (all cores by default).
+
+    No more workers are started than there are JSON files; with a single worker everything runs in-process.
+    """
+    json_files, pos_file = [], None
+    with os.scandir(folder) as entries:
+        for index, entry in enumerate(entries):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.json'):
+                json_files.append((index, entry.path))
+            elif entry.name.endswith('.pos') and pos_file is None:
+                pos_file = entry.path
 
     if pos_file is None:
         raise FileNotFoundError("No .pos file found in the folder.")
     
     pos_data = parse_pos_file(pos_file)
+    if pos_data is None:
+        raise IOError(f"Could not read .pos file {pos_file}")
+    if len(pos_data[0]) == 0:
+        raise ValueError(f"No GPS data found in .pos file {pos_file}")
+    tasks = [(json_file, f"{output_file}_{index}.json") for index, json_file in json_files]
 
-    for index, json_file in json_files:
-        json_data = parse_json_file(json_file)
-        associations = associate_timestamps_with_gps(json_data, pos_data)
-        centroid = calculate_centroid(associations)
-        geojson = generate_geojson_output(json_data, associations, centroid)
-        write_geojson_file(f"{output_file}_{index}.json", geojson)
+    workers = min(len(tasks), max_workers or os.cpu_count() or 1)
+    if workers <= 1:
+        # Writes run on background threads so the next file's computation overlaps the previous file's flush.
+        with ThreadPoolExecutor(max_workers=WRITER_THREADS) as writer:
+            writes = [
+                writer.submit(write_geojson_file, output_path, process_one(parse_json_file(json_file), *pos_data))
+                for json_file, output_path in tasks
+            ]
+        for write in writes:
+            write.result()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(pos_data,)) as executor:
+            list(executor.map(_process_task, tasks))
 #----------------------------------------------------------------------------------------------------------------#
 
 
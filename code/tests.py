@@ -1,22 +1,42 @@
 import unittest
 from unittest.mock import patch, mock_open, MagicMock
-from datetime import datetime
 import json
 import os
+import tempfile
+import time
+
+import numpy as np
 
 from main import (
+    _init_worker,
     associate_timestamps_with_gps, 
     calculate_centroid,
-    date_str_to_timestamp,
-    find_closest_timestamp, 
+    find_closest_indices,
     generate_geojson_output, 
+    nearest_gather,
     parse_json_file, 
     parse_pos_file,
+    pos_time_to_timestamp,
     process_files,
+    process_one,
     write_geojson_file,
 )
 
 
+def mock_scandir(*names):
+    """Build an os.scandir replacement yielding file entries with the given names."""
+    entries = []
+    for name in names:
+        entry = MagicMock()
+        entry.name = name
+        entry.path = os.path.join("folder", name)
+        entry.is_file.return_value = True
+        entries.append(entry)
+    scandir = MagicMock()
+    scandir.return_value.__enter__.return_value = iter(entries)
+    return scandir
+
+
 class TestGeoJsonProcessor(unittest.TestCase):
 
     @patch("builtins.open", new_callable=mock_open, read_data='{"timestamps": [[0, 1551949886217313489]], "device_alias": "CAM134", "end": 1551949946552588582, "beginning": 1551949886217313489, "filename": "P_G_07032019_SG_1_1_1_CAM134_110814_RAW_seg4.svo", "total": 480}')
@@ -33,56 +53,193 @@ class TestGeoJsonProcessor(unittest.TestCase):
         data = parse_json_file(file_path)
         self.assertEqual(data, expected_data)
 
+    def test_parse_json_file_is_memoized(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_path = os.path.join(folder, "test.json")
+            with open(file_path, 'w') as file:
+                file.write('{"timestamps": [[0, 1551949886217313489]], "total": 1}')
+            data = parse_json_file(file_path)
+            self.assertEqual(data, {"timestamps": [[0, 1551949886217313489]], "total": 1})
+            self.assertIs(parse_json_file(file_path), data)
+
+            stat = os.stat(file_path)
+            with open(file_path, 'w') as file:
+                file.write('{"timestamps": [], "total": 0}')
+            os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+            self.assertEqual(parse_json_file(file_path)["total"], 0)
+
+            stat = os.stat(file_path)
+            with open(file_path, 'w') as file:
+                file.write('{"timestamps": [[5, 6]], "total": 1}')
+            os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            self.assertEqual(parse_json_file(file_path)["timestamps"], [[5, 6]])
+
     @patch("builtins.open", new_callable=mock_open, read_data="%  GPST ...\n2024/01/01 00:00:00.000 40.712776 -74.005974\n2024/01/01 00:01:00.000 40.712776 -74.005974\n")
     def test_parse_pos_file(self, mock_file):
         file_path = "test.pos"
-        expected_data = [
-            (1704060000000000000, 40.712776, -74.005974),
-            (1704060060000000000, 40.712776, -74.005974)
-        ]
-        data = parse_pos_file(file_path)
-        self.assertEqual(data, expected_data)
+        timestamps, latitudes, longitudes = parse_pos_file(file_path)
+        self.assertEqual(timestamps.dtype, np.int64)
+        self.assertEqual(timestamps.tolist(), [1704060000000000000, 1704060060000000000])
+        self.assertEqual(latitudes.tolist(), [40.712776, 40.712776])
+        self.assertEqual(longitudes.tolist(), [-74.005974, -74.005974])
+
+    def test_parse_pos_file_ignores_corrupt_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_path = os.path.join(folder, "test.pos")
+            with open(file_path, 'w') as file:
+                file.write("%  GPST ...\n2024/01/01 00:00:00.000 40.712776 -74.005974\n")
+            expected = parse_pos_file(file_path, use_cache=False)
+            for garbage in (b"", b"not an npz archive", b"PK\x03\x04 truncated"):
+                with open(file_path + ".cache.npz", 'wb') as file:
+                    file.write(garbage)
+                pos_data = parse_pos_file(file_path)
+                for column, expected_column in zip(pos_data, expected):
+                    self.assertEqual(column.tolist(), expected_column.tolist())
+
+    @patch("builtins.open", new_callable=mock_open, read_data="% program   : RTKLIB\n%  GPST ...\n\n2024/01/01 00:00:00.000 40.0 -74.0\n% comment\n   \n2024/01/01 00:01:00.000 41.0 -73.0\n")
+    def test_parse_pos_file_skips_comments_and_blank_lines(self, mock_file):
+        timestamps, latitudes, longitudes = parse_pos_file("test.pos")
+        self.assertEqual(len(timestamps), 2)
+        self.assertEqual(latitudes.tolist(), [40.0, 41.0])
+        self.assertEqual(longitudes.tolist(), [-74.0, -73.0])
 
-    def test_date_str_to_timestamp(self):
-        dt = datetime.strptime("2024/01/01 00:00:00.000", "%Y/%m/%d %H:%M:%S.%f")
-        expected_timestamp = 1704060000000000000
-        timestamp = date_str_to_timestamp(dt)
+    @patch("builtins.open", new_callable=mock_open, read_data="%  GPST ...\n2024/01/01 00:01:00.000 41.0 -73.0\n2024/01/01 00:00:00.000 40.0 -74.0\n")
+    def test_parse_pos_file_sorts_timestamps(self, mock_file):
+        timestamps, latitudes, longitudes = parse_pos_file("test.pos")
+        self.assertTrue(np.all(np.diff(timestamps) > 0))
+        self.assertEqual(timestamps.tolist(), [pos_time_to_timestamp("2024/01/01", "00:00:00.000"), pos_time_to_timestamp("2024/01/01", "00:01:00.000")])
+        self.assertEqual(latitudes.tolist(), [40.0, 41.0])
+        self.assertEqual(longitudes.tolist(), [-74.0, -73.0])
+
+    @patch("builtins.open", new_callable=mock_open, read_data="%  GPST ...\n2024/01/01 00:00:00.000 nan -74.0\n2024/01/01 00:01:00.000 41.0 -73.0\n")
+    def test_parse_pos_file_skips_invalid_coordinates(self, mock_file):
+        timestamps, latitudes, longitudes = parse_pos_file("test.pos")
+        self.assertEqual(len(timestamps), 1)
+        self.assertEqual(latitudes.tolist(), [41.0])
+        self.assertEqual(longitudes.tolist(), [-73.0])
+
+    def test_parse_pos_file_uses_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_path = os.path.join(folder, "test.pos")
+            with open(file_path, 'w') as file:
+                file.write("%  GPST ...\n2024/01/01 00:00:00.000 40.712776 -74.005974\n")
+            timestamps, latitudes, longitudes = parse_pos_file(file_path)
+            self.assertTrue(os.path.exists(file_path + ".cache.npz"))
+
+            with patch("main.pos_time_to_timestamp", side_effect=AssertionError("cache not used")):
+                cached = parse_pos_file(file_path)
+            self.assertEqual(cached[0].tolist(), timestamps.tolist())
+            self.assertEqual(cached[1].tolist(), latitudes.tolist())
+            self.assertEqual(cached[2].tolist(), longitudes.tolist())
+
+            with open(file_path, 'a') as file:
+                file.write("2024/01/01 00:01:00.000 40.712776 -74.005974\n")
+            self.assertEqual(len(parse_pos_file(file_path)[0]), 2)
+
+    @patch("builtins.open", new_callable=mock_open, read_data="% program   : RTKLIB ver.2.4.2\n2024/01/01 00:00:00.000 40.712776 -74.005974\n")
+    def test_parse_pos_file_without_header(self, mock_file):
+        timestamps, latitudes, longitudes = parse_pos_file("test.pos")
+        self.assertEqual(len(timestamps), 0)
+        self.assertEqual(len(latitudes), 0)
+        self.assertEqual(len(longitudes), 0)
+
+    def test_pos_time_to_timestamp(self):
+        # .pos times are local time, so the expected epoch depends on the timezone the tests run in.
+        expected_timestamp = int(time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1))) * 1_000_000_000
+        timestamp = pos_time_to_timestamp("2024/01/01", "00:00:00.000")
         self.assertEqual(timestamp, expected_timestamp)
 
-    def test_find_closest_timestamp(self):
-        pos_data = [
-            (1577836800000000000, 40.712776, -74.005974),
-            (1577836860000000000, 40.712776, -74.005974)
-        ]
-        target_timestamp = 1577836830000000000
-        expected_coords = (40.712776, -74.005974)
-        coords = find_closest_timestamp(pos_data, target_timestamp)
-        self.assertEqual(coords, expected_coords)
+    def test_pos_time_to_timestamp_fraction(self):
+        midnight = pos_time_to_timestamp("2024/01/01", "00:00:00")
+        self.assertEqual(pos_time_to_timestamp("2024/01/01", "00:00:01.157") - midnight, 1_157_000_000)
+        self.assertEqual(pos_time_to_timestamp("2024/01/01", "00:00:01") - midnight, 1_000_000_000)
+        self.assertEqual(pos_time_to_timestamp("2024/01/01", "00:00:01.123456789") - midnight, 1_123_456_789)
+
+    def test_find_closest_indices(self):
+        timestamps = np.array([100, 200, 300], dtype=np.int64)
+        targets = np.array([0, 150, 240, 260, 999], dtype=np.int64)
+        indices = find_closest_indices(timestamps, targets)
+        self.assertEqual(indices.tolist(), [0, 0, 1, 2, 2])
+
+    def test_nearest_gather(self):
+        timestamps = np.array([100, 200, 300], dtype=np.int64)
+        latitudes = np.array([1.0, 2.0, 3.0])
+        longitudes = np.array([10.0, 20.0, 30.0])
+        targets = np.array([0, 150, 240, 260, 999], dtype=np.int64)
+        out_latitudes = np.empty(len(targets))
+        out_longitudes = np.empty(len(targets))
+        nearest_gather(timestamps, latitudes, longitudes, targets, out_latitudes, out_longitudes)
+        self.assertEqual(out_latitudes.tolist(), [1.0, 1.0, 2.0, 3.0, 3.0])
+        self.assertEqual(out_longitudes.tolist(), [10.0, 10.0, 20.0, 30.0, 30.0])
 
     def test_associate_timestamps_with_gps(self):
         json_data = {
             "timestamps": [[0, 1577836800000000000], [1, 1577836860000000000]]
         }
-        pos_data = [
-            (1577836800000000000, 40.712776, -74.005974),
-            (1577836860000000000, 40.712776, -74.005974)
-        ]
-        expected_associations = [
-            {'index': 0, 'timestamp': 1577836800000000000, 'latitude': 40.712776, 'longitude': -74.005974},
-            {'index': 1, 'timestamp': 1577836860000000000, 'latitude': 40.712776, 'longitude': -74.005974}
-        ]
-        associations = associate_timestamps_with_gps(json_data, pos_data)
-        self.assertEqual(associations, expected_associations)
+        pos_data = (
+            np.array([1577836800000000000, 1577836860000000000], dtype=np.int64),
+            np.array([40.712776, 40.712776]),
+            np.array([-74.005974, -74.005974])
+        )
+        indices, timestamps, latitudes, longitudes = associate_timestamps_with_gps(json_data, pos_data)
+        self.assertEqual(indices.tolist(), [0, 1])
+        self.assertEqual(timestamps.tolist(), [1577836800000000000, 1577836860000000000])
+        self.assertEqual(latitudes.tolist(), [40.712776, 40.712776])
+        self.assertEqual(longitudes.tolist(), [-74.005974, -74.005974])
+
+    def test_associate_timestamps_with_gps_extra_frame_fields(self):
+        json_data = {"timestamps": [[0, 100, 7], [1, 300, 9]]}
+        pos_data = (np.array([100, 300], dtype=np.int64), np.array([1.0, 3.0]), np.array([10.0, 30.0]))
+        indices, timestamps, latitudes, longitudes = associate_timestamps_with_gps(json_data, pos_data)
+        self.assertEqual(indices.tolist(), [0, 1])
+        self.assertEqual(timestamps.tolist(), [100, 300])
+        self.assertEqual(latitudes.tolist(), [1.0, 3.0])
+
+    def test_associate_timestamps_with_gps_malformed_frames(self):
+        pos_data = (np.array([100], dtype=np.int64), np.array([1.0]), np.array([10.0]))
+        with self.assertRaises(ValueError):
+            associate_timestamps_with_gps({"timestamps": [[0], [1]]}, pos_data)
+
+    def test_associate_timestamps_with_gps_no_frames(self):
+        pos_data = (np.array([100], dtype=np.int64), np.array([1.0]), np.array([10.0]))
+        indices, timestamps, latitudes, longitudes = associate_timestamps_with_gps({"timestamps": []}, pos_data)
+        self.assertEqual(len(indices), 0)
+        self.assertEqual(len(latitudes), 0)
+
+    def test_associate_timestamps_with_gps_empty_pos_data(self):
+        json_data = {"timestamps": [[0, 1577836800000000000]]}
+        pos_data = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+        with self.assertRaises(ValueError):
+            associate_timestamps_with_gps(json_data, pos_data)
+
+    def test_process_files_empty_pos_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, "empty.pos"), 'w') as file:
+                file.write("% program   : RTKLIB ver.2.4.2\n")
+            with open(os.path.join(folder, "frames.json"), 'w') as file:
+                file.write('{"timestamps": [[0, 1577836800000000000]]}')
+            with self.assertRaises(ValueError):
+                process_files(folder, output_file=os.path.join(folder, "out"), max_workers=1)
+            self.assertFalse(os.path.exists(os.path.join(folder, "out_0.json")))
+            self.assertFalse(os.path.exists(os.path.join(folder, "out_1.json")))
 
     def test_calculate_centroid(self):
-        locations = [
-            {'latitude': 40.712776, 'longitude': -74.005974},
-            {'latitude': 40.712776, 'longitude': -74.005974}
-        ]
+        latitudes = np.array([40.712776, 40.712776])
+        longitudes = np.array([-74.005974, -74.005974])
         expected_centroid = (40.712776, -74.005974)
-        centroid = calculate_centroid(locations)
+        centroid = calculate_centroid(latitudes, longitudes)
         self.assertEqual(centroid, expected_centroid)
 
+    def test_calculate_centroid_returns_floats(self):
+        centroid = calculate_centroid([1.0, 2.0, 3.0], [10.0, 20.0, 30.0])
+        self.assertEqual(centroid, (2.0, 20.0))
+        self.assertIs(type(centroid[0]), float)
+        self.assertIs(type(centroid[1]), float)
+
+    def test_calculate_centroid_empty(self):
+        with self.assertRaises(ValueError):
+            calculate_centroid(np.empty(0), np.empty(0))
+
     def test_generate_geojson_output(self):
         json_data = {
             "filename": "test.json",
@@ -92,10 +249,12 @@ class TestGeoJsonProcessor(unittest.TestCase):
             "end": "2024-01-01T01:00:00Z",
             "timestamps": [[0, 1577836800000000000], [1, 1577836860000000000]]
         }
-        associations = [
-            {'index': 0, 'timestamp': 1577836800000000000, 'latitude': 40.712776, 'longitude': -74.005974},
-            {'index': 1, 'timestamp': 1577836860000000000, 'latitude': 40.712776, 'longitude': -74.005974}
-        ]
+        associations = (
+            np.array([0, 1]),
+            np.array([1577836800000000000, 1577836860000000000], dtype=np.int64),
+            np.array([40.712776, 40.712776]),
+            np.array([-74.005974, -74.005974])
+        )
         centroid = (40.712776, -74.005974)
         expected_geojson = {
             "type": "FeatureCollection",
@@ -136,6 +295,19 @@ class TestGeoJsonProcessor(unittest.TestCase):
         geojson = generate_geojson_output(json_data, associations, centroid)
         self.assertEqual(geojson, expected_geojson)
 
+    def test_process_one(self):
+        json_data = {
+            "filename": "test.json",
+            "timestamps": [[0, 1577836800000000000], [1, 1577836859000000000]]
+        }
+        pos_timestamps = np.array([1577836800000000000, 1577836860000000000], dtype=np.int64)
+        pos_latitudes = np.array([40.0, 42.0])
+        pos_longitudes = np.array([-74.0, -72.0])
+        geojson = process_one(json_data, pos_timestamps, pos_latitudes, pos_longitudes)
+        self.assertEqual(geojson["centroid"], {"lat": 41.0, "lon": -73.0})
+        self.assertEqual([feature["geometry"]["coordinates"] for feature in geojson["features"]], [[-74.0, 40.0], [-72.0, 42.0]])
+        self.assertEqual([feature["properties"]["index"] for feature in geojson["features"]], [0, 1])
+
     @patch("builtins.open", new_callable=mock_open)
     def test_write_geojson_file(self, mock_file):
         filepath = "output.json"
@@ -144,20 +316,21 @@ class TestGeoJsonProcessor(unittest.TestCase):
             "features": []
         }
         write_geojson_file(filepath, geojson)
+        mock_file.assert_called_once_with(filepath, 'wb')
         mock_file_handle = mock_file()
-        written_data = "".join([call.args[0] for call in mock_file_handle.write.mock_calls])
-        self.assertEqual(written_data, json.dumps(geojson, indent=4))
+        written_data = b"".join([call.args[0] for call in mock_file_handle.write.mock_calls])
+        self.assertEqual(json.loads(written_data), geojson)
 
-    @patch("os.listdir", return_value=['file1.json', 'file2.json', 'file.pos'])
+    @patch("os.scandir", new_callable=lambda: mock_scandir('file1.json', 'file2.json', 'file.pos'))
     @patch("main.parse_json_file", return_value={"timestamps": [[0, 1577836800000000000], [1, 1577836860000000000]]})
-    @patch("main.parse_pos_file", return_value=[(1577836800000000000, 40.712776, -74.005974), (1577836860000000000, 40.712776, -74.005974)])
-    @patch("main.associate_timestamps_with_gps", return_value=[{'index': 0, 'timestamp': 1577836800000000000, 'latitude': 40.712776, 'longitude': -74.005974}, {'index': 1, 'timestamp': 1577836860000000000, 'latitude': 40.712776, 'longitude': -74.005974}])
+    @patch("main.parse_pos_file", return_value=(np.array([1577836800000000000, 1577836860000000000], dtype=np.int64), np.array([40.712776, 40.712776]), np.array([-74.005974, -74.005974])))
+    @patch("main.associate_timestamps_with_gps", return_value=(np.array([0, 1]), np.array([1577836800000000000, 1577836860000000000], dtype=np.int64), np.array([40.712776, 40.712776]), np.array([-74.005974, -74.005974])))
     @patch("main.calculate_centroid", return_value=(40.712776, -74.005974))
     @patch("main.generate_geojson_output", return_value={"type": "FeatureCollection", "features": []})
     @patch("main.write_geojson_file")
-    def test_process_files(self, mock_write_geojson_file, mock_generate_geojson_output, mock_calculate_centroid, mock_associate_timestamps_with_gps, mock_parse_pos_file, mock_parse_json_file, mock_listdir):
+    def test_process_files(self, mock_write_geojson_file, mock_generate_geojson_output, mock_calculate_centroid, mock_associate_timestamps_with_gps, mock_parse_pos_file, mock_parse_json_file, mock_scandir):
         folder = "folder"
-        process_files(folder)
+        process_files(folder, max_workers=1)
         mock_parse_pos_file.assert_called_once()
         self.assertEqual(mock_parse_json_file.call_count, 2)
         self.assertEqual(mock_associate_timestamps_with_gps.call_count, 2)
@@ -165,6 +338,49 @@ class TestGeoJsonProcessor(unittest.TestCase):
         self.assertEqual(mock_generate_geojson_output.call_count, 2)
         self.assertEqual(mock_write_geojson_file.call_count, 2)
 
+    @patch("os.scandir", new_callable=lambda: mock_scandir('file1.json', 'file2.json', 'file.pos'))
+    @patch("main.parse_pos_file", return_value=(np.array([1577836800000000000], dtype=np.int64), np.array([40.712776]), np.array([-74.005974])))
+    @patch("main.ProcessPoolExecutor")
+    def test_process_files_uses_process_pool(self, mock_executor, mock_parse_pos_file, mock_scandir):
+        process_files("folder", output_file="out", max_workers=16)
+        mock_executor.assert_called_once_with(max_workers=2, initializer=_init_worker, initargs=(mock_parse_pos_file.return_value,))
+        executor = mock_executor.return_value.__enter__.return_value
+        func, tasks = executor.map.call_args.args
+        self.assertEqual(tasks, [
+            (os.path.join("folder", "file1.json"), "out_0.json"),
+            (os.path.join("folder", "file2.json"), "out_1.json")
+        ])
+
+    @patch("os.scandir", new_callable=lambda: mock_scandir('file1.json', 'file.pos'))
+    @patch("main.parse_pos_file", return_value=(np.array([1577836800000000000], dtype=np.int64), np.array([40.712776]), np.array([-74.005974])))
+    @patch("main.ProcessPoolExecutor")
+    @patch("main.parse_json_file", return_value={"timestamps": [[0, 1577836800000000000]]})
+    @patch("main.write_geojson_file")
+    def test_process_files_single_file_runs_in_process(self, mock_write_geojson_file, mock_parse_json_file, mock_executor, mock_parse_pos_file, mock_scandir):
+        process_files("folder", max_workers=16)
+        mock_executor.assert_not_called()
+        mock_write_geojson_file.assert_called_once()
+
+    def test_process_files_process_pool_matches_in_process(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, "track.pos"), 'w') as file:
+                file.write("%  GPST ...\n2024/01/01 00:00:00.000 40.0 -74.0\n2024/01/01 00:01:00.000 41.0 -73.0\n")
+            base = pos_time_to_timestamp("2024/01/01", "00:00:00.000")
+            for name, offset in (("a.json", 10), ("b.json", 50)):
+                with open(os.path.join(folder, name), 'w') as file:
+                    json.dump({"filename": name, "timestamps": [[0, base + offset * 10**9], [1, base + (offset + 5) * 10**9]]}, file)
+
+            with tempfile.TemporaryDirectory() as output_folder:
+                process_files(folder, output_file=os.path.join(output_folder, "serial"), max_workers=1)
+                process_files(folder, output_file=os.path.join(output_folder, "pool"), max_workers=2)
+
+                # Output indices follow directory positions, which the first run's .pos cache sidecar shifts.
+                outputs = {"serial_": [], "pool_": []}
+                for name in os.listdir(output_folder):
+                    with open(os.path.join(output_folder, name), 'rb') as file:
+                        outputs[name[:name.index("_") + 1]].append(file.read())
+                self.assertEqual(len(outputs["serial_"]), 2)
+                self.assertEqual(sorted(outputs["pool_"]), sorted(outputs["serial_"]))
 
 if __name__ == "__main__":
     unittest.main()